@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import os
+import re
 import shutil
 import sys
 
 import docopt
 
 from apefind.util import script
+from apefind.util.path import walk_files
 
 log = script.get_logger()
 
 USAGE = """usage:
-    clean_brew_casks.py [--simulate]
+    clean_brew_casks.py [--simulate] [--root=<dir>] [--keep=<n>] [--jobs=<n>]
+
+options:
+    --root=<dir>    caskroom or cellar to clean [default: /usr/local/Caskroom]
+    --keep=<n>      number of versions to keep per cask, at least 1 [default: 1]
+    --jobs=<n>      number of parallel scans and removals [default: 8]
 """
 
 
@@ -32,23 +40,61 @@ def get_cask_versions(caskdir):
     return versions
 
 
-def get_old_cask_versions(caskdir):
-    return sorted(get_cask_versions(caskdir))[:-1]
+def get_version_key(version):
+    """Compare numbers numerically, so 10.0 comes after 9.1, and pre-releases like 2.0beta before 2.0"""
+    tokens = re.findall(r"\d+|[^\W\d_]+", os.path.basename(version))
+    return [(int(t), "") if t.isdigit() else (-1, t) for t in tokens] + [(-1, "~")]  # ~ sorts after letters
+
+
+def get_old_cask_versions(caskdir, keep=1):
+    versions = sorted(get_cask_versions(caskdir), key=get_version_key)
+    return versions[:-max(keep, 1)]  # the newest version is always kept
+
 
+def get_size(path):
+    return sum(e.size for e in walk_files(path, stat=True))
 
-def clean_brew_casks(caskroom, simulate=False):
-    log.info("    * removing old brew casks")
-    for caskdir in get_cask_directories(caskroom):
-        log.info("        " + os.path.basename(caskdir))
-        for version in get_old_cask_versions(caskdir):
-            log.info("            " + os.path.basename(version))
-            if not simulate:
-                shutil.rmtree(version)
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
+
+
+def clean_brew_casks(caskroom, simulate=False, keep=1, jobs=8):
+    log.info("    * removing old brew casks from " + caskroom)
+    versions = []
+    for caskdir in sorted(get_cask_directories(caskroom)):
+        old = get_old_cask_versions(caskdir, keep)
+        if old:
+            log.info("        " + os.path.basename(caskdir))
+            for version in old:
+                log.info("            " + os.path.basename(version))
+            versions += old
+    if not versions:
+        return 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        size = sum(pool.map(get_size, versions))
+        log.info("    * %d old versions, %s can be reclaimed" % (len(versions), format_size(size)))
+        if simulate:
+            return size
+        futures = {pool.submit(shutil.rmtree, version): version for version in versions}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except OSError as err:
+                log.warning("        %s: %s" % (futures[future], err))
+    return size
 
 
 @script.run()
 def run_script(args):
-    clean_brew_casks("/usr/local/Caskroom", args["--simulate"])
+    keep = int(args["--keep"])
+    if keep < 1:
+        raise ValueError(f"--keep must be at least 1, not {keep}")
+    clean_brew_casks(args["--root"], args["--simulate"], keep, int(args["--jobs"]))
 
 
 if __name__ == "__main__":
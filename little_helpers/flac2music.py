@@ -1,21 +1,37 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import hashlib
+import io
+import logging
 import os
 import pathlib
+import re
+import shlex
 import shutil
 import subprocess
+import tempfile
+import threading
 import zipfile
-from typing import Tuple
+import zlib
+from typing import List, NamedTuple, Tuple
 
 import PIL.Image
 import PIL.ImageFile
 import PIL.ImageFilter
 import eyed3
+import eyed3.id3
 import rarfile
 
 from apefind.util import script
+from apefind.util.path import read_cache, write_cache
 
-log = script.get_logger()
+log = script.get_logger(queued=True)
+
+_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+_album = threading.local()
+
+MANIFEST = ".flac2music.json"
 
 
 def parse_args(args=None, namespace=None):
@@ -27,27 +43,105 @@ def parse_args(args=None, namespace=None):
     cmd.add_argument("-trash", default="~/Desktop", help="trash folder")
     cmd.add_argument("-passwords", type=tuple, default=(), help="password list for encrypted archives")
     cmd.add_argument("-cleanup", action="store_true", help="delete archives after unpacking")
-    cmd = parser.add_command("convert")
-    cmd.add_argument("-album", default=os.getcwd(), help="album directory")
-    cmd.add_argument("-flacdir", help="target directory for flac files")
-    cmd.add_argument("-mp3dir", help="target directory for mp3 files")
-    cmd.add_argument("-scale", type=int, default=2, help="scaling factor for mp3 conversion")
+    cmd.add_argument("-jobs", type=int, default=4, help="number of archives unpacked at the same time")
+    for command in "convert", "batch":
+        cmd = parser.add_command(command)
+        if command == "convert":
+            cmd.add_argument("-album", default=os.getcwd(), help="album directory")
+        else:
+            cmd.add_argument("-albums", nargs="*", default=(), help="album directories")
+            cmd.add_argument("-parent", help="directory containing album directories")
+        cmd.add_argument("-flacdir", help="target directory for flac files")
+        cmd.add_argument("-mp3dir", help="target directory for mp3 files")
+        cmd.add_argument("-scale", type=int, default=2, help="scaling factor for mp3 conversion")
+        cmd.add_argument("-jobs", type=int, default=os.cpu_count(), help="number of parallel external tools")
+        cmd.add_argument("-direct", action="store_true", help="encode cue images straight to mp3 without flac files")
     return parser.parse_args(args=args, namespace=namespace, defaults=f"~/.config/{script.get_script_name()}.yaml")
 
 
+class AlbumFilter(logging.Filter):
+    """Put the album of the logging thread in front of each message, batch albums log in parallel"""
+
+    def filter(self, record):
+        name = getattr(_album, "name", None)
+        if name is not None:
+            indent, message = re.match(r"(\s*(?:\* )?)(.*)", record.getMessage(), re.S).groups()
+            record.msg, record.args = f"{indent}{name}: {message}", None
+        return True
+
+
+log.addFilter(AlbumFilter())
+
+
+def set_jobs(jobs):
+    """Set the global number of external tools allowed to run at the same time"""
+    global _slots
+    _slots = threading.BoundedSemaphore(jobs or os.cpu_count() or 1)
+
+
+def run_command(cmd):
+    """Run an external tool in one of the slots it shares with hashing and tagging"""
+    with _slots:
+        return subprocess.getstatusoutput(cmd)
+
+
 def unpack_music(downloads: pathlib.Path, music: pathlib.Path, trash: pathlib.Path, passwords: Tuple[str],
-                 cleanup: bool = False):
-    def is_music_archive(ar):
-        for filepath in ar.namelist():
-            if pathlib.PurePath(filepath).suffix.lower() in (".mp3", ".flac", ".wma", ".ape", ".m4a", ".cue"):
-                return True
-        return False
+                 cleanup: bool = False, jobs: int = 4):
+    def open_archive(archive):
+        if archive.suffix.lower() == ".rar":
+            return rarfile.RarFile(archive)
+        return zipfile.ZipFile(archive)
+
+    def get_password(ar, pwd):
+        return pwd if isinstance(ar, rarfile.RarFile) else bytes(pwd, "utf-8")
+
+    def is_encrypted(info):
+        if isinstance(info, zipfile.ZipInfo):
+            return bool(info.flag_bits & 0x1)
+        return info.needs_password()
+
+    def get_archive_index(ar):
+        """Return music flag, common top directory and encrypted members from a single pass"""
+        is_music, top, encrypted = False, None, []
+        for i, info in enumerate(ar.infolist()):
+            path = pathlib.PurePath(info.filename)
+            if path.suffix.lower() in (".mp3", ".flac", ".wma", ".ape", ".m4a", ".cue"):
+                is_music = True
+            if i == 0:
+                top = path.parts[0]
+            elif top is not None and path.parts[0] != top:
+                top = None
+            if not info.is_dir() and is_encrypted(info):
+                encrypted.append(info)
+        return is_music, top, encrypted
+
+    def check_password(ar, member, pwd):
+        try:
+            if member is None:  # rar with encrypted headers
+                ar.setpassword(pwd)
+                return bool(ar.infolist())
+            with ar.open(member, pwd=get_password(ar, pwd)) as f:
+                while f.read(1 << 20):
+                    pass
+            return True
+        except (RuntimeError, zipfile.BadZipFile, zlib.error, rarfile.Error):
+            return False  # zipcrypto lets about 1 in 256 wrong passwords pass its header check
+
+    def find_password(ar, index):
+        encrypted = [] if index is None else index[2]
+        if index is not None and not encrypted:
+            return None
+        member = min(encrypted, key=lambda info: info.file_size) if encrypted else None
+        for pwd in passwords:
+            if pwd is not None and check_password(ar, member, pwd):
+                return pwd
+        raise rarfile.PasswordRequired("no matching password")
 
-    def get_archive_dir(ar):
-        names = ar.namelist()
-        p = pathlib.PurePath(names[0]).parts[0]
-        if all(pathlib.PurePath(name).parts[0] == p for name in names):
-            return p
+    def reserve_target(target):
+        with lock:
+            if target.exists() or target in reserved:
+                raise AssertionError(f"{target.name} already exists")
+            reserved.add(target)
 
     def move_to_trash(archive):
         if cleanup:
@@ -55,89 +149,80 @@ def unpack_music(downloads: pathlib.Path, music: pathlib.Path, trash: pathlib.Pa
         else:
             shutil.move(str(archive), str(trash))
 
-    def unrar(archive, pwd=None):
-        with rarfile.RarFile(archive) as ar:
-            if pwd is None:
-                if ar.needs_password():
-                    raise rarfile.PasswordRequired("no password provided")
-            else:
-                ar.setpassword(pwd)
-            if not is_music_archive(ar):
-                raise AssertionError("not a music archive")
-            p = get_archive_dir(ar)
-            if p is None:
-                target = music / archive.stem
-                target.mkdir(parents=True)
-                unrar.target = target
-                ar.extractall(target)
-            else:
-                target = music / p
-                unrar.target = target
-                if target.exists():
-                    raise AssertionError(f"{p} already exists")
-                ar.extractall(music)
-        return target
-
-    def unzip(archive, pwd=None):
-        with zipfile.ZipFile(archive) as ar:
+    def extract(ar, staging):
+        """Extract member by member, applying directory and file modes as they are written"""
+        fixed = {staging}
+        staging.chmod(0o755)
+        for info in ar.infolist():
+            path = pathlib.Path(ar.extract(info, staging))
+            path.chmod(0o755 if info.is_dir() else 0o644)
+            for parent in path.parents:
+                if parent in fixed:
+                    break
+                parent.chmod(0o755)
+                fixed.add(parent)
+
+    def unpack(archive):
+        with open_archive(archive) as ar:
+            headers_encrypted = isinstance(ar, rarfile.RarFile) and ar.needs_password() and not ar.infolist()
+            index = None if headers_encrypted else get_archive_index(ar)
+            pwd = find_password(ar, index)
             if pwd is not None:
-                ar.setpassword(bytes(pwd, 'utf-8'))
-            if not is_music_archive(ar):
+                ar.setpassword(get_password(ar, pwd))
+            is_music, top, _ = get_archive_index(ar) if index is None else index
+            if not is_music:
                 raise AssertionError("not a music archive")
-            p = get_archive_dir(ar)
-            if p is None:
-                target = music / archive.stem
-                unzip.target = target
-                target.mkdir(parents=True)
-                ar.extractall(target)
-            else:
-                target = music / p
-                unzip.target = target
-                if target.exists():
-                    raise AssertionError(f"{p} already exists")
-                ar.extractall(music)
-        return target
-
-    def fix_permissions(target):
-        target.touch()
-        target.chmod(0o755)
-        for p in target.rglob("*"):
-            if p.is_dir():
-                p.chmod(0o755)
-            elif p.is_file():
-                p.chmod(0o644)
-
-    def unpack(archive, unar=unrar):
-        err = None
-        for pwd in passwords:
-            unrar.target = None
+            target = music / (archive.stem if top is None else top)
+            reserve_target(target)
+            staging = pathlib.Path(tempfile.mkdtemp(prefix=".unpacking-", dir=music))
             try:
-                target = unar(archive, pwd=pwd)
-                fix_permissions(target)
-                move_to_trash(archive)
-                return
-            except rarfile.BadRarFile as err_:
-                if unrar.target is not None:
-                    shutil.rmtree(unrar.target)
-                err = err_
-            except (AssertionError, rarfile.PasswordRequired, rarfile.NeedFirstVolume) as err_:
-                err = err_
-        if err:
-            raise err
+                extract(ar, staging)
+                if top is None:
+                    staging.rename(target)
+                else:
+                    (staging / top).rename(target)
+                    staging.rmdir()
+            except Exception:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+        move_to_trash(archive)
+        return archive
 
     log.info(f"    * extracting archives")
-    for archive in sorted(downloads.glob("*.rar")):
-        log.info(f"        {archive.name}")
-        try:
-            unpack(archive, unar=unrar)
-        except Exception as err:
-            log.warning(f"            {err}")
-    for archive in sorted(downloads.glob("*.zip")):
-        log.info(f"        {archive.name}")
-        try:
-            unpack(archive, unar=unzip)
-        except Exception as err:
-            log.warning(f"            {err}")
+    music.mkdir(parents=True, exist_ok=True)
+    lock, reserved = threading.Lock(), set()
+    archives = sorted(downloads.glob("*.rar")) + sorted(downloads.glob("*.zip"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(unpack, archive): archive for archive in archives}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                log.info(f"        {future.result().name}")
+            except Exception as err:
+                log.warning(f"        {futures[future].name}")
+                log.warning(f"            {err}")
+
+
+class AlbumIndex(NamedTuple):
+    album: pathlib.Path
+    flac: List[pathlib.Path]
+    ape: List[pathlib.Path]
+    cue: List[pathlib.Path]
+    covers: List[pathlib.Path]
+
+
+def scan_album(album, exclude=()):
+    """Walk the album tree once, skipping the excluded (output) directories"""
+    index = {"flac": [], "ape": [], "cue": [], "covers": []}
+    for root, dirs, files in os.walk(album):
+        root = pathlib.Path(root)
+        dirs[:] = sorted(d for d in dirs if root / d not in exclude)
+        for name in sorted(files):
+            suffix = os.path.splitext(name)[1].lower()[1:]
+            if suffix in index:
+                index[suffix].append(root / name)
+            if any(t in name.lower() for t in ("cover", "front", "folder")):
+                index["covers"].append(root / name)
+    return AlbumIndex(album, **index)
 
 
 def get_album_dirs(album, flacdir, mp3dir):
@@ -153,99 +238,329 @@ def get_album_dirs(album, flacdir, mp3dir):
     return album, flacdir, mp3dir
 
 
-def copy_cover(album, target):
-    def resize_cover(filepath, size=640):
-        cover = PIL.Image.open(filepath)
-        cover = cover.resize((size, size), PIL.Image.LANCZOS)
-        cover = cover.filter(PIL.ImageFilter.UnsharpMask(radius=1.5, percent=70, threshold=5))
-        cover.save(filepath)
+def prepare_cover(filepath, size=640):
+    """Return the resized cover as jpeg data, large jpeg scans are decoded at reduced size"""
+    with PIL.Image.open(filepath) as cover:
+        cover.draft("RGB", (size, size))
+        cover = cover.convert("RGB")
+    cover = cover.resize((size, size), PIL.Image.LANCZOS)
+    cover = cover.filter(PIL.ImageFilter.UnsharpMask(radius=1.5, percent=70, threshold=5))
+    with io.BytesIO() as f:
+        cover.save(f, "JPEG")
+        return f.getvalue()
 
-    for p in album.glob("**/*"):
-        if not p.is_file():
-            continue
-        if any(t in p.name.lower() for t in ("cover", "front", "folder")):
-            cover = target / "Cover.jpg"
-            resize_cover(shutil.copy(p, cover))
-            return cover
 
+def copy_cover(index, target):
+    for p in index.covers:
+        cover = prepare_cover(p)
+        with open(target / "Cover.jpg", "wb") as f:
+            f.write(cover)
+        return cover
 
-def add_cover_art(cover, mp3dir):
-    for mp3 in sorted(mp3dir.glob("*.mp3")):
-        audio = eyed3.load(mp3)
-        if audio.tag is None:
-            audio.initTag()
-        with open(cover, "rb") as f:
-            audio.tag.images.set(3, f.read(), 'image/jpeg')
-        audio.tag.save()
 
+def add_cover_art(cover, mp3s, jobs=4):
+    def add_cover(mp3):
+        with _slots:
+            tag = eyed3.id3.Tag()
+            if not tag.parse(str(mp3)):
+                tag = eyed3.id3.Tag()
+            tag.images.set(3, cover, "image/jpeg")
+            tag.save(str(mp3))
 
-def splitting_required(album):
-    return len(list(album.rglob("*.cue"))) > 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(add_cover, sorted(mp3s)))
 
 
-def split_flac(album, flacdir, title="%n %t"):
-    def cue_to_utf8(cue):
-        try:
-            with open(cue, "r") as f:
-                data = f.read()
-        except UnicodeDecodeError:
-            with open(cue, "r", encoding="latin-1") as f:
-                data = f.read()
-        cue = flacdir / cue.name
-        with open(cue, "w", encoding="utf-8") as f:
-            f.write(data)
-        return cue
-
-    def get_audio_and_cue():
-        audio, cues = list(album.rglob("*.flac")), list(album.rglob("*.cue"))
-        if not audio:
-            audio = list(album.rglob("*.ape"))
-        assert len(audio) == len(cues) == 1
-        return audio[0], cue_to_utf8(cues[0])
-
-    def split_audio(audio, cue):
-        cmd = f'shnsplit -d "{flacdir}" -f "{cue}" -t "{title}" -o flac "{audio}"'
-        status, stdout = subprocess.getstatusoutput(cmd)
-        if status:
-            raise OSError(stdout)
-        for f in flacdir.glob("*.flac"):
-            if "pregap" in f.name:
-                f.unlink()
-        return sorted(flacdir.rglob("*.flac"))
-
-    def tag_flacs(flacs, cue):
-        args = " ".join(f'"{f}"' for f in flacs)
-        cmd = f'cuetag.sh "{cue}" {args}'
-        status, stdout = subprocess.getstatusoutput(cmd)
-        if status or any(t in stdout for t in ("error", "warning")):
-            raise OSError(stdout)
+def splitting_required(index):
+    return len(index.cue) > 0
 
-    log.info(f"    * converting {album.name}")
-    audio, cue = get_audio_and_cue()
-    log.info(f"    * splitting {audio.name}")
-    flacs = split_audio(audio, cue)
-    for f in flacs:
-        log.info(f"        {f.name}")
-    log.info(f"    * tagging flac files")
-    tag_flacs(flacs, cue)
 
+def read_cue(filepath):
+    try:
+        with open(filepath, "r", encoding="utf-8-sig") as f:
+            return f.read()
+    except UnicodeDecodeError:
+        with open(filepath, "r", encoding="latin-1") as f:
+            return f.read()
 
-def convert_flac(album, flacdir, mp3dir, scale=2):
-    log.info(f"    * converting to mp3")
-    for flac in sorted(flacdir.glob("*.flac")):
-        mp3 = mp3dir / flac.with_suffix(".mp3").name
-        log.info(f"        {mp3.name}")
-        if mp3.exists():
+
+def parse_cue(filepath):
+    """Return album metadata and tracks of a cue sheet, track starts are in cd frames (1/75 s)"""
+    album, tracks = {}, []
+    for line in read_cue(filepath).splitlines():
+        words = [a or b for a, b in re.findall(r'"([^"]*)"|(\S+)', line)]
+        if len(words) < 2:
+            continue
+        key, args = words[0].upper(), words[1:]
+        if key == "REM":
+            key, args = args[0].upper(), args[1:]
+        current = tracks[-1] if tracks else album
+        if key in ("TITLE", "PERFORMER", "SONGWRITER", "GENRE", "DATE"):
+            current[key.lower()] = " ".join(args)
+        elif key == "FILE":
+            album["file"] = args[0]
+        elif key == "TRACK":
+            tracks.append({"number": int(args[0])})
+        elif key == "INDEX" and tracks and len(args) == 2 and int(args[0]) == 1:
+            mm, ss, ff = (int(t) for t in args[1].split(":"))
+            tracks[-1]["start"] = (mm * 60 + ss) * 75 + ff
+    return album, [track for track in tracks if "start" in track]
+
+
+def get_track_tags(album, track, total):
+    """Return ffmpeg's generic metadata keys, mapped to vorbis comments for flac and id3 frames for mp3"""
+    tags = {
+        "title": track.get("title", ""),
+        "artist": track.get("performer", album.get("performer", "")),
+        "album_artist": album.get("performer", ""),
+        "album": album.get("title", ""),
+        "track": f"{track['number']}/{total}",
+        "date": album.get("date", ""),
+        "genre": album.get("genre", ""),
+        "composer": track.get("songwriter", ""),
+    }
+    return {k: v for k, v in tags.items() if v}
+
+
+def get_track_name(track, title="{number:02d} {title}"):
+    return title.format(number=track["number"], title=track.get("title", "")).replace("/", "-").strip()
+
+
+def cut_track(audio, target, start, end, tags, codec="-codec:a flac"):
+    """Cut [start, end) cd frames from audio, seeking to the whole second before start
+
+    atrim rounds its microsecond times to the nearest sample of the decoded stream,
+    so the cut points are right for any sample rate without probing it.
+    """
+    seconds = start // 75
+    trim = f"atrim=start={(start - seconds * 75) / 75:.6f}"
+    if end is not None:
+        trim += f":end={(end - seconds * 75) / 75:.6f}"
+    metadata = " ".join(f"-metadata {shlex.quote(f'{k}={v}')}" for k, v in tags.items())
+    part = target.with_name(target.name + ".part")
+    cmd = (f"ffmpeg -y -ss {seconds} -i {shlex.quote(str(audio))} -af {trim},asetpts=N/SR/TB -map_metadata -1 "
+           f"{metadata} {codec} -f {target.suffix[1:]} {shlex.quote(str(part))}")
+    status, stdout = run_command(cmd)
+    if status:
+        part.unlink(missing_ok=True)
+        raise OSError(stdout)
+    os.replace(part, target)
+    return target
+
+
+def get_audio_and_cue(index):
+    audio, cues = index.flac, index.cue
+    if not audio:
+        audio = index.ape
+    assert len(audio) == len(cues) == 1
+    return audio[0], cues[0]
+
+
+def get_cue_tracks(audio, cue, title="{number:02d} {title}"):
+    """Return name, start, end and tags of every track, end is None for the last one"""
+    metadata, tracks = parse_cue(cue)
+    if not tracks:
+        raise OSError(f"no tracks found in {cue.name}")
+    ends = [track["start"] for track in tracks[1:]] + [None]
+    return [
+        (get_track_name(track, title), track["start"], end, get_track_tags(metadata, track, len(tracks)))
+        for track, end in zip(tracks, ends)
+    ]
+
+
+def split_flac(index, flacdir, title="{number:02d} {title}", jobs=None):
+    """Cut every cue track to flac, tracks already cut from the unchanged image are kept as they are"""
+    log.info(f"    * converting {index.album.name}")
+    audio, cue = get_audio_and_cue(index)
+    log.info(f"    * splitting and tagging {audio.name}")
+    return cut_cue_tracks(audio, cue, flacdir, ".flac", "-codec:a flac", {}, title, jobs)[0]
+
+
+def get_file_hash(filepath, size=1 << 20):
+    h = hashlib.sha256()
+    with _slots, open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(directory):
+    return read_cache(str(directory / MANIFEST))
+
+
+def write_manifest(directory, manifest):
+    write_cache(str(directory / MANIFEST), manifest, indent=4)
+
+
+def get_manifest_entry(source, settings, sha=None):
+    st = source.stat()
+    return {
+        "source": source.name,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "hash": sha if sha is not None else get_file_hash(source),
+        "settings": settings,
+    }
+
+
+def is_converted(manifest, source, target, settings):
+    """Check the manifest entry of target, the source is only hashed if its mtime changed"""
+    entry = manifest.get(target.name)
+    if entry is None or entry["settings"] != settings or not target.exists():
+        return False
+    st = source.stat()
+    if st.st_size != entry["size"]:
+        return False
+    if st.st_mtime_ns != entry["mtime"]:
+        if get_file_hash(source) != entry["hash"]:
+            return False
+        entry["mtime"] = st.st_mtime_ns
+    return True
+
+
+def get_pending_conversions(outdir, conversions):
+    """Return the manifest of outdir and the (target, source, settings, args) conversions it does not cover"""
+    manifest, pending = read_manifest(outdir), []
+    for target, source, settings, args in conversions:
+        if is_converted(manifest, source, target, settings):
+            log.info(f"        {target.name}")
             continue
-        cmd = f'ffmpeg -i "{flac}" -codec:a libmp3lame -qscale:a {scale} "{mp3}"'
-        status, stdout = subprocess.getstatusoutput(cmd)
+        manifest.pop(target.name, None)
+        pending.append((target, source, settings, args))
+    write_manifest(outdir, manifest)
+    return manifest, pending
+
+
+def run_conversions(outdir, manifest, pending, convert, jobs=None):
+    """Run convert(target, source, settings, *args) -> manifest entry on a pool, return the converted targets"""
+    def run(target, source, settings, args):
+        return target, convert(target, source, settings, *args)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = [pool.submit(run, *conversion) for conversion in pending]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                target, entry = future.result()
+                manifest[target.name] = entry
+                write_manifest(outdir, manifest)
+                log.info(f"        {target.name}")
+        except Exception:
+            pool.shutdown(cancel_futures=True)
+            raise
+    return [target for target, _, _, _ in pending]
+
+
+def cut_cue_tracks(audio, cue, outdir, suffix, codec, settings, title="{number:02d} {title}", jobs=None):
+    """Cut the cue tracks of audio into outdir, return all targets and the ones actually cut"""
+    def cut(target, source, settings, start, end, tags):
+        cut_track(source, target, start, end, tags, codec=codec)
+        return get_manifest_entry(source, settings, sha)
+
+    targets, conversions = [], []
+    for name, start, end, tags in get_cue_tracks(audio, cue, title):
+        target = outdir / f"{name}{suffix}"
+        targets.append(target)
+        conversions.append((target, audio, {**settings, "start": start, "end": end, "tags": tags}, (start, end, tags)))
+    manifest, pending = get_pending_conversions(outdir, conversions)
+    sha = get_file_hash(audio) if pending else None
+    return targets, run_conversions(outdir, manifest, pending, cut, jobs)
+
+
+def convert_flac(index, flacs, mp3dir, scale=2, jobs=None):
+    def encode(mp3, flac, settings):
+        sha = get_file_hash(flac)
+        part = mp3.with_name(mp3.name + ".part")
+        cmd = f'ffmpeg -y -i "{flac}" -codec:a libmp3lame -qscale:a {scale} -f mp3 "{part}"'
+        status, stdout = run_command(cmd)
         if status:
+            part.unlink(missing_ok=True)
             raise OSError(stdout)
-    log.info(f"    * copying cover")
-    cover = copy_cover(album, mp3dir)
-    if cover is not None:
-        log.info(f"    * adding cover art")
-        add_cover_art(cover, mp3dir)
+        os.replace(part, mp3)
+        return get_manifest_entry(flac, settings, sha)
+
+    log.info(f"    * converting to mp3")
+    settings = {"codec": "libmp3lame", "qscale": scale}
+    flacs = sorted(flacs)
+    mp3s = [mp3dir / flac.with_suffix(".mp3").name for flac in flacs]
+    manifest, pending = get_pending_conversions(mp3dir, [(mp3, flac, settings, ()) for mp3, flac in zip(mp3s, flacs)])
+    converted = run_conversions(mp3dir, manifest, pending, encode, jobs)
+    convert_cover(index, mp3dir, mp3s, converted)
+
+
+def convert_cue(index, mp3dir, scale=2, title="{number:02d} {title}", jobs=None):
+    """Encode every cue track straight from the image to mp3, skipping the intermediate flac files"""
+    log.info(f"    * converting {index.album.name}")
+    audio, cue = get_audio_and_cue(index)
+    log.info(f"    * converting {audio.name} to mp3")
+    settings = {"codec": "libmp3lame", "qscale": scale}
+    codec = f"-codec:a libmp3lame -qscale:a {scale}"
+    mp3s, converted = cut_cue_tracks(audio, cue, mp3dir, ".mp3", codec, settings, title, jobs)
+    convert_cover(index, mp3dir, mp3s, converted)
+
+
+def convert_cover(index, mp3dir, mp3s, converted=None):
+    """Embed the cover, only into the converted mp3s and without decoding it again if it did not change"""
+    if not index.covers:
+        return
+    source, target, settings = index.covers[0], mp3dir / "Cover.jpg", {"cover": 640}
+    manifest = read_manifest(mp3dir)
+    if converted is not None and is_converted(manifest, source, target, settings):
+        if not converted:
+            return
+        with open(target, "rb") as f:
+            cover = f.read()
+        mp3s = converted
+    else:
+        log.info(f"    * copying cover")
+        cover = copy_cover(index, mp3dir)
+    log.info(f"    * adding cover art")
+    add_cover_art(cover, mp3s)
+    manifest[target.name] = get_manifest_entry(source, settings)
+    write_manifest(mp3dir, manifest)
+
+
+def convert_album(album, flacdir, mp3dir, scale=2, jobs=None, direct=False):
+    index = scan_album(album, exclude=(flacdir, mp3dir))
+    mp3dir.mkdir(parents=True, exist_ok=True)
+    if splitting_required(index) and direct:
+        convert_cue(index, mp3dir, scale, jobs=jobs)
+    elif splitting_required(index):
+        flacdir.mkdir(parents=True, exist_ok=True)
+        flacs = split_flac(index, flacdir, jobs=jobs)
+        convert_flac(index, flacs, mp3dir, scale, jobs)
+    else:
+        convert_flac(index, [p for p in index.flac if p.parent == album], mp3dir, scale, jobs)
+
+
+def get_batch_albums(albums, parent=None):
+    albums = [pathlib.Path(album).expanduser() for album in albums]
+    if parent is not None:
+        albums.extend(p for p in sorted(pathlib.Path(parent).expanduser().iterdir()) if p.is_dir())
+    return albums
+
+
+def convert_albums(albums, flacdir, mp3dir, scale=2, jobs=None, direct=False):
+    def convert(album):
+        _album.name = album.name
+        try:
+            convert_album(*get_album_dirs(album, flacdir, mp3dir), scale, jobs, direct)
+        finally:
+            _album.name = None
+        return album
+
+    log.info(f"    * converting {len(albums)} albums")
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {pool.submit(convert, album): album for album in albums}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                log.info(f"    * {future.result().name} done")
+            except Exception as err:
+                log.warning(f"    * {futures[future].name} failed")
+                log.warning(f"        {err}")
+                failed.append(futures[future])
+    if failed:
+        raise OSError(f"{len(failed)} of {len(albums)} albums failed")
 
 
 @script.run()
@@ -253,16 +568,14 @@ def run_script(args):
     if args.cmd == "unpack":
         downloads, music = pathlib.Path(args.downloads).expanduser(), pathlib.Path(args.music).expanduser()
         trash = pathlib.Path(args.trash).expanduser()
-        unpack_music(downloads, music, trash, (None,) + tuple(args.passwords), args.cleanup)
+        unpack_music(downloads, music, trash, (None,) + tuple(args.passwords), args.cleanup, args.jobs)
     elif args.cmd == "convert":
-        album, flacdir, mp3dir = get_album_dirs(args.album, args.flacdir, args.mp3dir)
-        mp3dir.mkdir(parents=True, exist_ok=True)
-        if splitting_required(album):
-            flacdir.mkdir(parents=True, exist_ok=True)
-            split_flac(album, flacdir)
-            convert_flac(album, flacdir, mp3dir, args.scale)
-        else:
-            convert_flac(album, album, mp3dir, args.scale)
+        set_jobs(args.jobs)
+        convert_album(*get_album_dirs(args.album, args.flacdir, args.mp3dir), args.scale, args.jobs, args.direct)
+    elif args.cmd == "batch":
+        set_jobs(args.jobs)
+        albums = get_batch_albums(args.albums, args.parent)
+        convert_albums(albums, args.flacdir, args.mp3dir, args.scale, args.jobs, args.direct)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import pathlib
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import PIL.Image
+
+from apefind.little_helpers import flac2music
+from apefind.util import script
+
+log = script.get_logger()
+
+
+def parse_args(args=None, namespace=None):
+    parser = script.ArgumentParser()
+    parser.add_argument("-workdir", help="directory for the synthetic albums, a temporary one by default")
+    parser.add_argument("-tracks", type=int, default=10, help="number of tracks per album")
+    parser.add_argument("-duration", type=int, default=30, help="track duration in seconds")
+    parser.add_argument("-covers", type=int, nargs="*", default=(600, 3000, 6000), help="cover scan sizes")
+    parser.add_argument("-scale", type=int, default=2, help="scaling factor for mp3 conversion")
+    parser.add_argument("-jobs", type=int, default=os.cpu_count(), help="number of parallel external tools")
+    parser.add_argument("-repeat", type=int, default=3, help="number of runs per stage")
+    parser.add_argument("-output", default="flac2music_bench.json", help="json report")
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process and of its largest child in MB so far
+
+    Both are high-water marks over the whole run, not per stage.
+    """
+    factor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / factor,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / factor,
+    )
+
+
+def get_size(paths):
+    return sum(p.stat().st_size for p in paths)
+
+
+def generate_tone(filepath, frequency, duration):
+    cmd = (f'ffmpeg -y -f lavfi -i "sine=frequency={frequency}:sample_rate=44100:duration={duration}" '
+           f'-ac 2 -codec:a flac "{filepath}"')
+    status, stdout = subprocess.getstatusoutput(cmd)
+    if status:
+        raise OSError(stdout)
+    return filepath
+
+
+def generate_tracks_album(album, tracks, duration):
+    album.mkdir(parents=True)
+    for n in range(1, tracks + 1):
+        generate_tone(album / f"{n:02d} Tone {220 + 20 * n} Hz.flac", 220 + 20 * n, duration)
+    return album
+
+
+def generate_image_album(album, tracks, duration):
+    album.mkdir(parents=True)
+    image = generate_tone(album / "Image.flac", 440, tracks * duration)
+    lines = ['PERFORMER "Benchmark"', 'TITLE "Image"', f'FILE "{image.name}" WAVE']
+    for n in range(tracks):
+        lines += [f"  TRACK {n + 1:02d} AUDIO", f'    TITLE "Tone {n + 1}"',
+                  f"    INDEX 01 {n * duration // 60:02d}:{n * duration % 60:02d}:00"]
+    with open(album / "Image.cue", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return album
+
+
+def generate_cover(filepath, size):
+    cover = PIL.Image.effect_mandelbrot((size, size), (-2.0, -1.5, 1.0, 1.5), 100).convert("RGB")
+    cover.save(filepath, quality=95)
+    return filepath
+
+
+def generate_archive(archive, album):
+    with zipfile.ZipFile(archive, "w") as ar:
+        for p in sorted(album.rglob("*")):
+            ar.write(p, p.relative_to(album.parent))
+    return archive
+
+
+def benchmark(name, f, tracks, size, repeat, setup=None):
+    """Time repeat runs of f, setup prepares every run and is not timed"""
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        t0 = time.perf_counter()
+        f(*args)
+        timings.append(time.perf_counter() - t0)
+    best = min(timings)
+    rss, children_rss = get_peak_rss()
+    result = {
+        "stage": name,
+        "runs": timings,
+        "best": best,
+        "tracks": tracks,
+        "mb": size / 1e6,
+        "tracks_per_sec": tracks / best if best else None,
+        "mb_per_sec": size / 1e6 / best if best else None,
+        "cumulative_peak_rss_mb": rss,
+        "cumulative_peak_children_rss_mb": children_rss,
+    }
+    log.info(f"        {name}: {best:.3f}s, {result['tracks_per_sec']:.1f} tracks/s, {result['mb_per_sec']:.1f} MB/s")
+    return result
+
+
+def run_benchmarks(workdir, tracks=10, duration=30, covers=(600, 3000, 6000), scale=2, jobs=None, repeat=3):
+    flac2music.set_jobs(jobs)
+    log.info(f"    * generating synthetic albums in {workdir}")
+    source = generate_tracks_album(workdir / "source" / "Tracks", tracks, duration)
+    image = generate_image_album(workdir / "source" / "Image", tracks, duration)
+    archive = generate_archive(workdir / "source" / "Tracks.zip", source)
+    scans = [generate_cover(workdir / "source" / f"Cover {size}.jpg", size) for size in covers]
+    flacs = sorted(source.glob("*.flac"))
+
+    def fresh(name):
+        return pathlib.Path(tempfile.mkdtemp(prefix=f"{name}-", dir=workdir))
+
+    def setup_unpack():
+        downloads, music = fresh("downloads"), fresh("music")
+        shutil.copy(archive, downloads)
+        return downloads, music, workdir, (None,), True, jobs
+
+    def setup_convert():
+        return flac2music.scan_album(source), flacs, fresh("mp3"), scale, jobs
+
+    def setup_mp3s():
+        mp3dir = fresh("mp3s")
+        for flac in flacs:
+            cmd = f'ffmpeg -y -i "{flac}" -codec:a libmp3lame -qscale:a {scale} "{mp3dir / flac.with_suffix(".mp3").name}"'
+            status, stdout = subprocess.getstatusoutput(cmd)
+            if status:
+                raise OSError(stdout)
+        return mp3dir
+
+    def cover_stage(album, mp3dir):
+        cover = flac2music.copy_cover(flac2music.scan_album(album), mp3dir)
+        flac2music.add_cover_art(cover, list(mp3dir.glob("*.mp3")))
+
+    log.info(f"    * running benchmarks")
+    results = [
+        benchmark("unpack_music", flac2music.unpack_music, tracks, archive.stat().st_size, repeat, setup_unpack),
+        benchmark("split_flac", flac2music.split_flac, tracks, get_size(image.glob("*.flac")), repeat,
+                  lambda: (flac2music.scan_album(image), fresh("flac"), "{number:02d} {title}", jobs)),
+        benchmark("convert_cue", flac2music.convert_cue, tracks, get_size(image.glob("*.flac")), repeat,
+                  lambda: (flac2music.scan_album(image), fresh("mp3"), scale, "{number:02d} {title}", jobs)),
+        benchmark("convert_flac", flac2music.convert_flac, tracks, get_size(flacs), repeat, setup_convert),
+    ]
+    mp3dir = setup_mp3s()
+    for scan, size in zip(scans, covers):
+        def setup_cover_stage(scan=scan):
+            album, target = fresh("album"), fresh("cover")
+            shutil.copy(scan, album / "Cover.jpg")
+            for mp3 in mp3dir.glob("*.mp3"):
+                shutil.copy(mp3, target)
+            return album, target
+
+        results.append(benchmark(f"cover_{size}", cover_stage, tracks, scan.stat().st_size, repeat, setup_cover_stage))
+    return results
+
+
+def get_report(args, results):
+    status, ffmpeg = subprocess.getstatusoutput("ffmpeg -version")
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg.splitlines()[0] if not status else None,
+        "parameters": {
+            "tracks": args.tracks,
+            "duration": args.duration,
+            "covers": list(args.covers),
+            "scale": args.scale,
+            "jobs": args.jobs,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+@script.run()
+def run_script(args):
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory(prefix="flac2music-bench-") as workdir:
+            results = run_benchmarks(pathlib.Path(workdir), args.tracks, args.duration, args.covers, args.scale,
+                                     args.jobs, args.repeat)
+    else:
+        workdir = pathlib.Path(args.workdir).expanduser()
+        workdir.mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(workdir, args.tracks, args.duration, args.covers, args.scale, args.jobs, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(get_report(args, results), f, indent=4)
+    log.info(f"    * report written to {args.output}")
+
+
+if __name__ == "__main__":
+    run_script(parse_args())
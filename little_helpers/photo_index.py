@@ -1,47 +1,142 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
 import mimetypes
 import os
+import re
+import sqlite3
 
 from apefind.util import script
+from apefind.util.path import expand_path, read_cache, write_cache
 
-log = script.get_logger()
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+log = script.get_logger(queued=True)
+
+EXIF_IFD, EXIF_DATETIME, EXIF_DATETIME_ORIGINAL = 0x8769, 306, 36867
 
 
 def get_parser():
     parser = script.ArgumentParser()
-    parser.add_argument("path", nargs=argparse.REMAINDER)
+    parser.add_argument("-cache", default="~/.cache/photo_index.json", help="index cache, empty to disable")
+    parser.add_argument("-db", default="~/.cache/photo_index.db", help="sqlite database")
+    parser.add_argument("-jobs", type=int, default=8, help="number of year folders scanned at the same time")
+    parser.add_commands(required=True)
+    for command in "index", "export", "thumbnails":
+        cmd = parser.add_command(command)
+        if command == "thumbnails":
+            cmd.add_argument("-thumbdir", default="~/.cache/photo_index/thumbnails", help="thumbnail cache")
+            cmd.add_argument("-sheetdir", default="~/.cache/photo_index/sheets", help="contact sheets")
+            cmd.add_argument("-size", type=int, default=256, help="thumbnail size")
+            cmd.add_argument("-columns", type=int, default=8, help="thumbnails per contact sheet row")
+        cmd.add_argument("path", nargs=argparse.REMAINDER)
+    cmd = parser.add_command("query")
+    cmd.add_argument("-year", help="photos of a year")
+    cmd.add_argument("-date", help="months with a date containing this text")
+    cmd.add_argument("-term", nargs="*", default=(), help="months with descriptions mentioning all terms")
     return parser
 
 
-def get_subdirectories(path):
-    return sorted(
-        [
-            path + os.sep + f
-            for f in os.listdir(path)
-            if os.path.isdir(path + os.sep + f)
-        ]
-    )
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_subdirectories(path, cache=None):
+    key = get_mtime(path)
+    entry = cache.get(path) if cache is not None else None
+    if entry is not None and entry["mtime"] == key:
+        return entry["subdirectories"]
+    with os.scandir(path) as it:
+        subdirectories = sorted(path + os.sep + e.name for e in it if e.is_dir())
+    if cache is not None:
+        cache[path] = {"mtime": key, "subdirectories": subdirectories}
+    return subdirectories
 
 
-def get_year_photos(path):
-    L = []
-    for d in get_subdirectories(path):
-        description = d + os.sep + "DESCRIPTION.txt"
-        if os.path.isfile(description):
-            with open(description, "r") as f:
-                date, content = get_description_content(f.readlines())
-            n = len([f for f in os.listdir(d) if is_picture(f)])
+def get_exif_date(filepath):
+    """Return the capture date from the exif header, the image data is never decoded"""
+    if PIL is None:
+        return None
+    try:
+        with PIL.Image.open(filepath) as image:
+            exif = image.getexif()
+            date = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    except Exception:
+        return None
+    if not isinstance(date, str) or len(date) < 10:
+        return None
+    return date[:10].replace(":", "-")
+
+
+def get_exif_dates(d, pictures, cached=None, jobs=8):
+    """Return the capture dates of the pictures, reusing cached ones with unchanged size and mtime"""
+    cached = cached or {}
+    dates, pending = {}, []
+    for e in pictures:
+        st = e.stat()
+        key = [st.st_size, st.st_mtime_ns]
+        entry = cached.get(e.name)
+        if entry is not None and entry[:2] == key:
+            dates[e.name] = entry
         else:
-            date, content = "", []
-        n = len([f for f in os.listdir(d) if is_picture(f)])
-        L.append((d, date, content, n))
-    return L
+            pending.append((e.name, key))
+    if pending:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for (name, key), date in zip(pending, pool.map(get_exif_date, (d + os.sep + n for n, _ in pending))):
+                dates[name] = key + [date]
+    return dates
+
+
+def get_date_range(dates):
+    dates = sorted(entry[2] for entry in dates.values() if entry[2])
+    if not dates:
+        return ""
+    return dates[0] if dates[0] == dates[-1] else f"{dates[0]} - {dates[-1]}"
+
+
+def get_month_photos(d, cache=None):
+    """Return date, content and number of pictures, cached on the directory and description mtimes"""
+    description = d + os.sep + "DESCRIPTION.txt"
+    key = [get_mtime(d), get_mtime(description)]
+    entry = cache.get(d) if cache is not None else None
+    if entry is not None and entry["mtime"] == key:
+        return entry["date"], entry["content"], entry["n"]
+    with os.scandir(d) as it:
+        pictures = [e for e in it if is_picture(e.name)]
+    exif = {}
+    if key[1] is not None:
+        with open(description, "r") as f:
+            date, content = get_description_content(f.readlines())
+    else:
+        exif = get_exif_dates(d, pictures, entry.get("exif") if entry is not None else None)
+        date, content = get_date_range(exif), []
+    if cache is not None:
+        cache[d] = {"mtime": key, "date": date, "content": content, "n": len(pictures), "exif": exif}
+    return date, content, len(pictures)
+
+
+def get_year_photos(path, cache=None):
+    return [(d, *get_month_photos(d, cache)) for d in get_subdirectories(path, cache)]
 
 
 def is_picture(filename):
-    type, _ = mimetypes.guess_type(filename)
+    return is_picture_ext(os.path.splitext(filename)[1].lower())
+
+
+@functools.lru_cache(maxsize=None)
+def is_picture_ext(ext):
+    type, _ = mimetypes.guess_type("_" + ext)
     return type is not None and type[:5] == "image"
 
 
@@ -58,27 +153,189 @@ def clear_description(s):
     return s
 
 
-def print_index(path):
-    for y in get_subdirectories(path):
-        title = os.path.basename(y)
-        log.info("")
-        log.info(title)
-        log.info(len(title) * "=")
-        for m, date, content, n in get_year_photos(y):
-            title = f"{os.path.basename(m)} ({date}, {n} Photos)"
+def print_index(path, cache=None, jobs=8):
+    years = get_subdirectories(os.path.abspath(path), cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        photos = pool.map(lambda y: get_year_photos(y, cache), years)
+        for y, months in zip(years, photos):
+            title = os.path.basename(y)
             log.info("")
             log.info(title)
-            log.info(len(title) * "-")
-            for s in content:
-                log.info("    - " + s.title())
+            log.info(len(title) * "=")
+            for m, date, content, n in months:
+                title = f"{os.path.basename(m)} ({date}, {n} Photos)"
+                log.info("")
+                log.info(title)
+                log.info(len(title) * "-")
+                for s in content:
+                    log.info("    - " + s.title())
+
+
+def get_thumbnail_path(thumbdir, e, size):
+    """Thumbnails are cached under a hash of path, file size, mtime and thumbnail size"""
+    st = e.stat()
+    key = hashlib.sha1(f"{e.path}\0{st.st_size}\0{st.st_mtime_ns}\0{size}".encode()).hexdigest()
+    return os.path.join(thumbdir, key[:2], key + ".jpg")
+
+
+def make_thumbnail(source, target, size=256):
+    """Decode at reduced size if possible (jpeg draft mode) and write the thumbnail"""
+    try:
+        with PIL.Image.open(source) as image:
+            image.draft("RGB", (size, size))
+            image = PIL.ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((size, size))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        image.save(target + ".tmp", "JPEG")
+        os.replace(target + ".tmp", target)
+        return True
+    except Exception:
+        return False
+
+
+def make_contact_sheet(thumbnails, target, size=256, columns=8):
+    rows = max(1, -(-len(thumbnails) // columns))
+    sheet = PIL.Image.new("RGB", (columns * size, rows * size), "white")
+    for i, thumbnail in enumerate(thumbnails):
+        with PIL.Image.open(thumbnail) as image:
+            x, y = (i % columns) * size, (i // columns) * size
+            sheet.paste(image, (x + (size - image.width) // 2, y + (size - image.height) // 2))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    sheet.save(target + ".tmp", "JPEG")
+    os.replace(target + ".tmp", target)
+    return target
+
+
+def create_thumbnails(path, cache, thumbdir, sheetdir, size=256, columns=8, jobs=8):
+    """Render missing thumbnails and outdated contact sheets on a process pool"""
+    if PIL is None:
+        raise ImportError("thumbnails require Pillow")
+    path = os.path.abspath(path)
+    thumbnails, sheets = [], []
+    for y in get_subdirectories(path, cache):
+        for m, *_ in get_year_photos(y, cache):
+            with os.scandir(m) as it:
+                pictures = sorted((e for e in it if is_picture(e.name)), key=lambda e: e.name)
+            month = [(e.path, get_thumbnail_path(thumbdir, e, size)) for e in pictures]
+            thumbnails.extend((source, target) for source, target in month if not os.path.exists(target))
+            key = hashlib.sha1("\0".join(t for _, t in month).encode()).hexdigest()
+            sheet = os.path.join(sheetdir, os.path.basename(y), os.path.basename(m) + ".jpg")
+            entry = cache.get(m, {})
+            if month and (entry.get("sheet") != key or not os.path.exists(sheet)):
+                sheets.append((m, [t for _, t in month], sheet, key))
+    log.info(f"    * {path}: {len(thumbnails)} thumbnails, {len(sheets)} contact sheets")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        sources, targets = [s for s, _ in thumbnails], [t for _, t in thumbnails]
+        for source, ok in zip(sources, pool.map(make_thumbnail, sources, targets, [size] * len(sources))):
+            if not ok:
+                log.warning(f"        {source}: no thumbnail")
+        futures = {
+            pool.submit(make_contact_sheet, [t for t in month if os.path.exists(t)], sheet, size, columns): (m, key)
+            for m, month, sheet, key in sheets
+        }
+        for future in concurrent.futures.as_completed(futures):
+            m, key = futures[future]
+            log.info(f"        {future.result()}")
+            if m in cache:
+                cache[m]["sheet"] = key
+
+
+def get_terms(content):
+    return sorted({t for s in content for t in re.findall(r"\w+", s.lower())})
+
+
+def create_schema(con):
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS months (
+            path TEXT PRIMARY KEY, year TEXT, month TEXT, date TEXT, content TEXT, photos INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS terms (term TEXT, path TEXT);
+        CREATE INDEX IF NOT EXISTS months_year ON months(year);
+        CREATE INDEX IF NOT EXISTS months_date ON months(date);
+        CREATE INDEX IF NOT EXISTS terms_term ON terms(term);
+        CREATE INDEX IF NOT EXISTS terms_path ON terms(path);
+        """
+    )
+
+
+def export_index(con, path, cache=None, jobs=8):
+    """Upsert the months below path, rows are only rewritten if they changed"""
+    path = os.path.abspath(path)
+    prefix = path + os.sep
+    rows = {r[0]: r[1:] for r in con.execute(
+        "SELECT path, date, content, photos FROM months WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+    )}
+    updated = 0
+    years = get_subdirectories(path, cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for y, months in zip(years, pool.map(lambda y: get_year_photos(y, cache), years)):
+            for m, date, content, n in months:
+                row = (date, json.dumps(content), n)
+                if rows.pop(m, None) == row:
+                    continue
+                con.execute(
+                    "INSERT INTO months VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET "
+                    "date = excluded.date, content = excluded.content, photos = excluded.photos",
+                    (m, os.path.basename(y), os.path.basename(m), *row),
+                )
+                con.execute("DELETE FROM terms WHERE path = ?", (m,))
+                con.executemany("INSERT INTO terms VALUES (?, ?)", ((t, m) for t in get_terms(content)))
+                updated += 1
+    con.executemany("DELETE FROM terms WHERE path = ?", ((m,) for m in rows))
+    con.executemany("DELETE FROM months WHERE path = ?", ((m,) for m in rows))
+    log.info(f"    * {path}: {updated} months updated, {len(rows)} removed")
+
+
+def query_index(con, year=None, date=None, terms=()):
+    sql, params = "SELECT path, date, photos, content FROM months WHERE 1", []
+    if year is not None:
+        sql += " AND year = ?"
+        params.append(year)
+    if date is not None:
+        sql += " AND date LIKE ?"
+        params.append(f"%{date}%")
+    for t in terms:
+        sql += " AND path IN (SELECT path FROM terms WHERE term = ?)"
+        params.append(t.lower())
+    return con.execute(sql + " ORDER BY path", params).fetchall()
+
+
+def print_query(con, year=None, date=None, terms=()):
+    total = 0
+    for path, date_, n, content in query_index(con, year, date, terms):
+        log.info(f"{path} ({date_}, {n} Photos)")
+        for s in json.loads(content):
+            log.info("    - " + s.title())
+        total += n
+    log.info(f"{total} Photos")
 
 
 def run_script(args):
+    if args.cmd == "query":
+        with sqlite3.connect(expand_path(args.db)) as con:
+            create_schema(con)
+            print_query(con, args.year, args.date, args.term)
+        return
     title = "Photo Index"
     log.info(title)
     log.info(len(title) * "*")
-    for p in args.path:
-        print_index(p)
+    cache = read_cache(args.cache)
+    if args.cmd == "index":
+        for p in args.path:
+            print_index(p, cache, args.jobs)
+    elif args.cmd == "thumbnails":
+        thumbdir, sheetdir = expand_path(args.thumbdir), expand_path(args.sheetdir)
+        for p in args.path:
+            create_thumbnails(p, cache, thumbdir, sheetdir, args.size, args.columns, args.jobs)
+    elif args.cmd == "export":
+        db = expand_path(args.db)
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+        with sqlite3.connect(db) as con:
+            create_schema(con)
+            for p in args.path:
+                export_index(con, p, cache, args.jobs)
+    write_cache(args.cache, cache)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
 import mimetypes
+import mmap
 import os
 import pathlib
 
 from apefind.util import script
+from apefind.util.path import walk_files
 
-log = script.get_logger()
+log = script.get_logger(queued=True)
 
 
 def get_parser():
@@ -15,6 +21,9 @@ def get_parser():
     parser.add_argument("-start", type=int)
     parser.add_argument("-template", default="Pic_{n:06d}{suffix}")
     parser.add_argument("-config", default="~/.config/lastpic")
+    parser.add_argument("-duplicates", choices=("skip", "report", "off"), default="skip",
+                        help="skip or only report byte-identical pictures before numbering")
+    parser.add_argument("-jobs", type=int, default=8, help="number of files hashed at the same time")
     parser.add_argument("paths", nargs=argparse.REMAINDER)
     return parser
 
@@ -39,32 +48,121 @@ def save_counter(n, config):
         f.write(str(n))
 
 
-def rename_pictures(p, n, template):
-    for e in p.rglob(f"*.*"):
-        if not is_pic(e):
-            continue
+def get_pictures(p):
+    return sorted(pathlib.Path(e.path) for e in walk_files(p) if is_pic(e.name))
+
+
+def get_file_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+    return h.hexdigest()
+
+
+def find_duplicates(pictures, jobs=8):
+    """Return duplicate -> first identical picture, only pictures sharing their size are hashed"""
+    sizes = collections.defaultdict(list)
+    for e in pictures:
+        sizes[e.stat().st_size].append(e)
+    candidates = [e for group in sizes.values() if len(group) > 1 for e in group]
+    duplicates, originals = {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for e, h in zip(candidates, pool.map(get_file_hash, candidates)):
+            original = originals.setdefault(h, e)
+            if original is not e:
+                duplicates[e] = original
+    return duplicates
+
+
+def get_rename_plan(pictures, n, template):
+    plan = []
+    for e in pictures:
         suffix = e.suffix
         filename = template.format(**locals())
-        log.info(f"        {e.parent.name}/{e.name} -> {filename}")
-        e.rename(e.parent / filename)
+        plan.append((str(e), str(e.parent / filename)))
         n += 1
-    return n
+    return plan, n
+
+
+def check_rename_plan(plan):
+    targets = set()
+    for source, target in plan:
+        if target in targets:
+            raise OSError(f"{target} is planned twice")
+        targets.add(target)
+        if target != source and os.path.lexists(target):
+            raise OSError(f"{target} already exists")
+
+
+def write_journal(journal, plan, n):
+    """Write the plan and the final counter, applied renames are appended one index per line"""
+    with open(journal + ".tmp", "w") as f:
+        f.write(json.dumps({"counter": n, "plan": plan}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(journal + ".tmp", journal)
+
+
+def read_journal(journal):
+    with open(journal, "r") as f:
+        header = json.loads(f.readline())
+        done = set()
+        for line in f:
+            try:
+                done.add(int(line))
+            except ValueError:
+                break  # torn last line
+    return header["plan"], header["counter"], done
+
+
+def apply_rename_plan(plan, journal, done=()):
+    with open(journal, "a") as f:
+        for i, (source, target) in enumerate(plan):
+            if i in done:
+                continue
+            if source == target:
+                pass
+            elif os.path.lexists(source):
+                log.info(f"        {os.path.basename(os.path.dirname(source))}/{os.path.basename(source)} -> "
+                         f"{os.path.basename(target)}")
+                os.rename(source, target)
+            elif not os.path.lexists(target):
+                log.warning(f"        {source} is missing")
+            f.write(f"{i}\n")
+            f.flush()
 
 
 @script.run()
 def run_script(args):
-    if not args.paths:
-        paths = [pathlib.Path.cwd()]
+    config = os.path.expanduser(args.config)
+    journal = config + ".journal"
+    if os.path.exists(journal):
+        log.info("    * resuming interrupted renaming")
+        plan, n, done = read_journal(journal)
     else:
-        paths = [pathlib.Path(p) for p in args.paths]
+        if not args.paths:
+            paths = [pathlib.Path.cwd()]
+        else:
+            paths = [pathlib.Path(p) for p in args.paths]
+        log.info("    * planning renames")
+        pictures = [e for p in paths if p.is_dir() for e in get_pictures(p)]
+        if args.duplicates != "off":
+            log.info("    * looking for duplicates")
+            duplicates = find_duplicates(pictures, args.jobs)
+            for e, original in duplicates.items():
+                log.warning(f"        {e} is identical to {original}")
+            if args.duplicates == "skip":
+                pictures = [e for e in pictures if e not in duplicates]
+        plan, n = get_rename_plan(pictures, get_counter(args.start, config), args.template)
+        done = set()
+        check_rename_plan(plan)
+        write_journal(journal, plan, n)
     log.info("    * renaming pictures")
-    config = os.path.expanduser(args.config)
-    n = get_counter(args.start, config)
-    for p in paths:
-        if not p.is_dir():
-            continue
-        n = rename_pictures(p, n, args.template)
+    apply_rename_plan(plan, journal, done)
     save_counter(n, config)
+    os.remove(journal)
 
 
 if __name__ == "__main__":
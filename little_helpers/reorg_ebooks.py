@@ -1,16 +1,31 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import os
 import pathlib
+import re
+import unicodedata
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
 
 from apefind.util import script
-from apefind.util.script import _ok
+from apefind.util.path import read_cache, write_cache
+from apefind.util.script import _ok, _nok
 
 log = script.get_logger()
 
+OPF_NS = {
+    "c": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "dc": "http://purl.org/dc/elements/1.1/",
+}
+
 
 def parse_args():
     parser = script.ArgumentParser()
+    parser.add_argument("-cache", default="~/.cache/reorg_ebooks.json", help="metadata cache, empty to disable")
+    parser.add_argument("-jobs", type=int, default=8, help="number of books read at the same time")
     parser.add_argument("path", nargs=argparse.REMAINDER)
     return parser.parse_args()
 
@@ -21,7 +36,262 @@ def fix_name(name):
     return name.strip()
 
 
-def get_author_and_book(p):
+def get_epub_metadata(filepath):
+    """Read creator and title from the opf record, only the central directory and two members are read"""
+    with zipfile.ZipFile(filepath) as ar:
+        container = ET.fromstring(ar.read("META-INF/container.xml"))
+        rootfile = container.find(".//c:rootfile", OPF_NS)
+        opf = ET.fromstring(ar.read(rootfile.get("full-path")))
+    creator, title = opf.find(".//dc:creator", OPF_NS), opf.find(".//dc:title", OPF_NS)
+    return (creator.text if creator is not None else None), (title.text if title is not None else None)
+
+
+def decode_pdf_string(s):
+    if s.startswith(b"<"):
+        data = bytes.fromhex(re.sub(rb"\s", b"", s[1:-1]).decode("ascii"))
+    else:
+        data, escapes = bytearray(), {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
+        i, s = 0, s[1:-1]
+        while i < len(s):
+            c = s[i:i + 1]
+            if c == b"\\":
+                m = re.match(rb"[0-7]{1,3}", s[i + 1:i + 4])
+                if m:
+                    data.append(int(m.group(), 8) & 0xFF)
+                    i += 1 + len(m.group())
+                    continue
+                c = escapes.get(s[i + 1:i + 2], s[i + 1:i + 2] if s[i + 1:i + 2] not in b"\r\n" else b"")
+                i += 1
+            data += c
+            i += 1
+        data = bytes(data)
+    if data.startswith(b"\xfe\xff"):
+        return data[2:].decode("utf-16-be", "replace").strip()
+    return data.decode("latin-1").strip()
+
+
+def get_pdf_string_end(data, i):
+    """Return the index after the literal string starting at i, balanced parentheses included"""
+    nesting, i = 1, i + 1
+    while i < len(data) and nesting:
+        c = data[i:i + 1]
+        nesting += 1 if c == b"(" else -1 if c == b")" else 0
+        i += 2 if c == b"\\" else 1
+    return i
+
+
+def get_pdf_string(dictionary, key):
+    m = re.search(rb"/" + key + rb"(?![\w#])\s*([(<])", dictionary)
+    if m is None:
+        return None
+    start = m.start(1)
+    if m.group(1) == b"(":
+        end = get_pdf_string_end(dictionary, start)
+    elif re.match(rb"<[0-9A-Fa-f\s]*>", dictionary[start:]):
+        end = dictionary.find(b">", start) + 1
+    else:
+        return None
+    return decode_pdf_string(dictionary[start:end])
+
+
+def get_pdf_dictionary_end(data, start):
+    """Return the index after the >> closing the dictionary at start, skipping strings and comments"""
+    depth, i = 0, start
+    while i < len(data):
+        if data.startswith(b"<<", i):
+            depth, i = depth + 1, i + 2
+        elif data.startswith(b">>", i):
+            depth, i = depth - 1, i + 2
+            if depth == 0:
+                return i
+        elif data[i:i + 1] == b"(":
+            i = get_pdf_string_end(data, i)
+        elif data[i:i + 1] == b"<":
+            i = data.find(b">", i) + 1 or len(data)
+        elif data[i:i + 1] == b"%":
+            while i < len(data) and data[i:i + 1] not in b"\r\n":
+                i += 1
+        else:
+            i += 1
+    return len(data)
+
+
+def read_pdf_object(f, offset, size=4096):
+    """Return the object at offset up to the end of its dictionary, or up to endobj if it has none"""
+    f.seek(offset)
+    data = f.read(size)
+    start, end = data.find(b"<<"), data.find(b"endobj")
+    if start < 0 or 0 <= end < start:
+        return data[:end] if end >= 0 else data
+    return data[:get_pdf_dictionary_end(data, start)]
+
+
+def read_pdf_stream(f, offset, header):
+    """Return the decompressed data of the flate stream whose dictionary header starts at offset"""
+    length = re.search(rb"/Length\s+(\d+)(?!\s+\d+\s+R)", header)
+    if length is None:
+        raise ValueError("indirect stream length")
+    f.seek(offset + len(header))
+    keyword = f.read(64).find(b"stream")
+    if keyword < 0:
+        raise ValueError("missing stream keyword")
+    f.seek(offset + len(header) + keyword + len(b"stream"))
+    eol = f.read(2)
+    f.seek(-1 if eol[:1] == b"\n" else 0, os.SEEK_CUR)
+    return zlib.decompress(f.read(int(length.group(1))))
+
+
+def read_pdf_object_stream(f, offset, index):
+    """Return object index of the object stream at offset"""
+    header = read_pdf_object(f, offset)
+    n, first = (int(re.search(rb"/" + key + rb"\s+(\d+)", header).group(1)) for key in (b"N", b"First"))
+    data = read_pdf_stream(f, offset, header)
+    numbers = data[:first].split()
+    start = first + int(numbers[2 * index + 1])
+    end = first + int(numbers[2 * index + 3]) if index + 1 < n else len(data)
+    return data[start:end]
+
+
+def read_pdf_xref_table(f, offset, number):
+    """Return the offset of object number (or None) and the trailer of a classic xref section"""
+    found = None
+    f.seek(offset)
+    f.readline()
+    while True:
+        line = f.readline()
+        if not line or line.startswith(b"trailer"):
+            return found, line + f.read(4096)
+        first, count = (int(x) for x in line.split()[:2])
+        start = f.tell()
+        if first <= number < first + count:
+            f.seek(start + (number - first) * 20)
+            entry = f.read(20)
+            if entry[17:18] == b"n":
+                found = int(entry[:10])
+        f.seek(start + count * 20)
+
+
+def read_pdf_xref_stream(f, offset, number):
+    """Return the offset of object number, (object stream, index) if it is compressed or None,
+    and the dictionary of a xref stream"""
+    trailer = read_pdf_object(f, offset)
+    w = re.search(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]", trailer)
+    if w is None:
+        return None, trailer
+    w = [int(x) for x in w.groups()]
+    m = re.search(rb"/Index\s*\[([\d\s]+)\]", trailer)
+    index = [int(x) for x in m.group(1).split()] if m else [0, int(re.search(rb"/Size\s+(\d+)", trailer).group(1))]
+    data = read_pdf_stream(f, offset, trailer)
+    row = sum(w)
+    if b"/Predictor" in trailer:  # png up predictor, one filter byte per row
+        rows, prev = [], bytearray(row)
+        for i in range(0, len(data), row + 1):
+            line = bytearray(data[i + 1:i + 1 + row])
+            if data[i] == 2:
+                line = bytearray((a + b) & 0xFF for a, b in zip(line, prev))
+            rows.append(bytes(line))
+            prev = line
+        data = b"".join(rows)
+    i = 0
+    for first, count in zip(index[::2], index[1::2]):
+        if first <= number < first + count:
+            entry = data[(i + number - first) * row:(i + number - first + 1) * row]
+            kind = int.from_bytes(entry[:w[0]], "big") if w[0] else 1
+            field, index = (int.from_bytes(entry[w[0] + j:w[0] + j + k], "big") for j, k in ((0, w[1]), (w[1], w[2])))
+            if kind == 1:
+                return field, trailer
+            return ((field, index) if kind == 2 else None), trailer
+        i += count
+    return None, trailer
+
+
+def read_pdf_xref(f, offset, number):
+    f.seek(offset)
+    if f.read(4) == b"xref":
+        return read_pdf_xref_table(f, offset, number)
+    return read_pdf_xref_stream(f, offset, number)
+
+
+def walk_pdf_xref(f, start, number):
+    """Yield the entry of object number and the trailer of every xref section, newest first"""
+    offset, seen = start, set()
+    while offset is not None and offset not in seen:
+        seen.add(offset)
+        found, trailer = read_pdf_xref(f, offset, number)
+        yield found, trailer
+        m = re.search(rb"/Prev\s+(\d+)", trailer)
+        offset = int(m.group(1)) if m else None
+
+
+def find_pdf_object(f, start, number):
+    for found, _ in walk_pdf_xref(f, start, number):
+        if isinstance(found, int):
+            return read_pdf_object(f, found)
+        if found is not None:
+            stream, index = found
+            for found_, _ in walk_pdf_xref(f, start, stream):
+                if isinstance(found_, int):
+                    return read_pdf_object_stream(f, found_, index)
+            return None
+    return None
+
+
+def get_pdf_metadata(filepath):
+    """Read author and title from the info dictionary, only the trailers, the xref and the info object are read"""
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        tail = f.read()
+        m = re.search(rb"startxref\s+(\d+)", tail[tail.rfind(b"startxref"):])
+        if m is None:
+            return None, None
+        start = int(m.group(1))
+        for _, trailer in walk_pdf_xref(f, start, -1):
+            info = re.search(rb"/Info\s+(\d+)\s+\d+\s+R", trailer)
+            if info is not None:
+                dictionary = find_pdf_object(f, start, int(info.group(1)))
+                break
+        else:
+            return None, None
+    if dictionary is None:
+        return None, None
+    return get_pdf_string(dictionary, b"Author"), get_pdf_string(dictionary, b"Title")
+
+
+def get_book_metadata(filepath):
+    try:
+        if filepath.suffix.lower() == ".epub":
+            return get_epub_metadata(filepath)
+        if filepath.suffix.lower() == ".pdf":
+            return get_pdf_metadata(filepath)
+    except Exception:
+        pass
+    return None, None
+
+
+def get_cached_metadata(filepath, cache):
+    st = filepath.stat()
+    key = [st.st_size, st.st_mtime_ns]
+    entry = cache.get(str(filepath))
+    if entry is not None and entry["key"] == key:
+        return entry["metadata"]
+    metadata = get_book_metadata(filepath)
+    cache[str(filepath)] = {"key": key, "metadata": metadata}
+    return metadata
+
+
+def get_metadata_name(s):
+    """Return s on a single line without control characters and with / replaced, usable as a file name"""
+    if not s:
+        return s
+    s = "".join(c if unicodedata.category(c)[0] != "C" else " " for c in s)
+    return " ".join(s.replace("/", "-").split())
+
+
+def get_author_and_book(p, metadata=(None, None)):
+    author, title = (get_metadata_name(s) for s in metadata)
+    if author and title:
+        return author, title + p.suffix
     if " - " not in p.name:
         return p.parent.name, p.name
     S = p.name.split("-")
@@ -34,30 +304,40 @@ def get_full_book_title(author, book):
     return f"{author} - {book}"
 
 
-def reorganize_author(root):
+def reorganize_author(root, cache, jobs=8):
     log.info(f"        {root} {_ok}")
-    for p in sorted(root.iterdir()):
-        if not p.is_file():
-            continue
-        author, book = get_author_and_book(p)
+    books = [p for p in sorted(root.iterdir()) if p.is_file()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        metadata = list(pool.map(lambda p: get_cached_metadata(p, cache), books))
+    for p, m in zip(books, metadata):
+        author, book = get_author_and_book(p, m)
         full_title = get_full_book_title(author, book)
         if p.name == full_title:
             continue
+        target = root / full_title
+        if os.path.lexists(target) and not (target.exists() and os.path.samefile(p, target)):
+            log.warning(f"            {p.name} → {full_title} already exists, skipped {_nok}")
+            continue
         log.info(f"            {book} → {full_title} {_ok}")
-        p.rename(root / full_title)
+        p.rename(target)
+        cache[str(root / full_title)] = cache.pop(str(p))
 
 
-def reorganize_genre(root):
+def reorganize_genre(root, cache, jobs=8):
     for p in sorted(root.iterdir()):
         if p.is_dir():
-            reorganize_author(p)
+            reorganize_author(p, cache, jobs)
 
 
 @script.run()
 def run_script(args):
     log.info(f"    * reorganizing books")
-    for p in args.path:
-        reorganize_genre(pathlib.Path(p))
+    cache = read_cache(args.cache)
+    try:
+        for p in args.path:
+            reorganize_genre(pathlib.Path(p).absolute(), cache, args.jobs)
+    finally:
+        write_cache(args.cache, cache)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,28 @@
 #!/usr/bin/env python
 
+import argparse
+import collections
+import concurrent.futures
+import os
 import pathlib
-import sys
+
+from apefind.util.path import read_cache, write_cache
+
+ID3_FRAMES = {
+    2: {"TP1": "artist", "TP2": "albumartist", "TAL": "album"},
+    3: {"TPE1": "artist", "TPE2": "albumartist", "TALB": "album"},
+    4: {"TPE1": "artist", "TPE2": "albumartist", "TALB": "album"},
+}
+ID3_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-tags", action="store_true", help="group albums by their id3 artist and album tags")
+    parser.add_argument("-cache", default="~/.cache/reorg_mp3.json", help="tag cache, empty to disable")
+    parser.add_argument("-jobs", type=int, default=16, help="number of files read at the same time")
+    parser.add_argument("path", nargs="*")
+    return parser.parse_args()
 
 
 def fix_name(name):
@@ -10,6 +31,105 @@ def fix_name(name):
     return name.strip()
 
 
+def get_syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_id3_text(data):
+    if not data:
+        return ""
+    try:
+        return data[1:].decode(ID3_ENCODINGS[data[0]]).split("\x00")[0].strip()
+    except (IndexError, UnicodeDecodeError):
+        return ""
+
+
+def parse_id3v2_frames(data, version):
+    tags, frames, i = {}, ID3_FRAMES[version], 0
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+    while i + header_size <= len(data) and data[i] != 0:
+        frame_id = data[i:i + id_size].decode("latin-1")
+        if version == 2:
+            size = int.from_bytes(data[i + 3:i + 6], "big")
+        elif version == 3:
+            size = int.from_bytes(data[i + 4:i + 8], "big")
+        else:
+            size = get_syncsafe(data[i + 4:i + 8])
+        if frame_id in frames:
+            tags[frames[frame_id]] = decode_id3_text(data[i + header_size:i + header_size + size])
+        i += header_size + size
+    return tags
+
+
+def read_id3_tags(filepath):
+    """Return the id3v2 header tags, or the id3v1 trailer ones, audio frames are never read"""
+    with open(filepath, "rb") as f:
+        header = f.read(10)
+        if len(header) == 10 and header[:3] == b"ID3" and header[3] in ID3_FRAMES:
+            version, flags = header[3], header[5]
+            data = f.read(get_syncsafe(header[6:10]))
+            if flags & 0x80 and version < 4:
+                data = data.replace(b"\xff\x00", b"\xff")
+            if flags & 0x40 and version == 3:
+                data = data[4 + int.from_bytes(data[:4], "big"):]
+            elif flags & 0x40:
+                data = data[get_syncsafe(data[:4]):]
+            tags = parse_id3v2_frames(data, version)
+            if tags:
+                return tags
+        if os.fstat(f.fileno()).st_size < 128:
+            return {}
+        f.seek(-128, os.SEEK_END)
+        data = f.read(128)
+    if data[:3] != b"TAG":
+        return {}
+    fields = {"artist": data[33:63], "album": data[63:93]}
+    return {k: v.split(b"\x00")[0].decode("latin-1").strip() for k, v in fields.items()}
+
+
+def get_album_dirs(root):
+    """Return the genre subdirectories and their subdirectories that contain mp3 files"""
+    albums = {}
+    for p in sorted(root.iterdir()):
+        if not p.is_dir():
+            continue
+        for q in [p] + sorted(q for q in p.iterdir() if q.is_dir()):
+            mp3s = sorted(e for e in q.iterdir() if e.suffix.lower() == ".mp3")
+            if mp3s:
+                albums[q] = mp3s
+    return albums
+
+
+def get_album_tags(albums, cache, jobs=16):
+    """Return album directory -> (artist, album) by majority of the cached or freshly read file tags"""
+    def read_tags(filepath):
+        st = filepath.stat()
+        key = [st.st_size, st.st_mtime_ns]
+        entry = cache.get(str(filepath))
+        if entry is not None and entry["key"] == key:
+            return entry["tags"]
+        try:
+            tags = read_id3_tags(filepath)
+        except OSError:
+            tags = {}
+        cache[str(filepath)] = {"key": key, "tags": tags}
+        return tags
+
+    files = [mp3 for mp3s in albums.values() for mp3 in mp3s]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        tags = dict(zip(files, pool.map(read_tags, files)))
+    result = {}
+    for p, mp3s in albums.items():
+        votes = collections.Counter(
+            (fix_name(t.get("albumartist") or t.get("artist", "")), fix_name(t.get("album", "")))
+            for t in (tags[mp3] for mp3 in mp3s)
+        )
+        (artist, album), _ = votes.most_common(1)[0]
+        if artist and album:
+            result[p] = artist.replace("/", "-"), album.replace("/", "-")
+    return result
+
+
 def get_artist_and_album(p, artist=None):
     name = fix_name(p.name)
     if artist is not None and " - " not in name:
@@ -24,40 +144,60 @@ def get_full_album_name(artist, album):
     return f"{artist} - {album}"
 
 
-def reorganize_artist(root, artist):
+def reorganize_artist(root, artist, tags=None):
     print(f"{artist} ✔")
     for p in sorted(root.iterdir()):
         if not p.is_dir():
             continue
-        artist_, album = get_artist_and_album(p, artist=artist)
-        if artist == artist_:
-            continue
+        if tags is not None and p in tags and tags[p][0] == artist:
+            album = tags[p][1]
+        else:
+            artist_, album = get_artist_and_album(p, artist=artist)
+            if artist == artist_:
+                continue
         full_album = get_full_album_name(artist, album)
         if p.name == full_album:
             continue
+        if os.path.lexists(root / full_album):
+            print(f"    {p.name} → {full_album} already exists, skipped ✗")
+            continue
         print(f"    {album} → {full_album} ✔")
         p.rename(root / full_album)
 
 
 def reorganize_album(root, artist, album):
     full_album = get_full_album_name(artist, album)
-    print(f"{artist} - {album} → {artist}/{full_album}")
     p = root.parent / artist
+    if os.path.lexists(p / full_album):
+        print(f"{root.name} → {artist}/{full_album} already exists, skipped ✗")
+        return
+    print(f"{artist} - {album} → {artist}/{full_album}")
     p.mkdir(exist_ok=True)
     root.rename(p / full_album)
 
 
-def reorganize_genre(root):
+def reorganize_genre(root, tags=None):
     for p in sorted(root.iterdir()):
         if not p.is_dir():
             continue
-        artist, album = get_artist_and_album(p)
+        if tags is not None and p in tags:
+            artist, album = tags[p]
+        else:
+            artist, album = get_artist_and_album(p)
         if artist == p.name:
-            reorganize_artist(p, artist)
+            reorganize_artist(p, artist, tags)
         else:
             reorganize_album(p, artist, album)
 
 
 if __name__ == "__main__":
-    for p in sys.argv[1:]:
-        reorganize_genre(pathlib.Path(p))
+    args = parse_args()
+    cache = read_cache(args.cache) if args.tags else {}
+    try:
+        for p in args.path:
+            root = pathlib.Path(p)
+            tags = get_album_tags(get_album_dirs(root), cache, args.jobs) if args.tags else None
+            reorganize_genre(root, tags)
+    finally:
+        if args.tags:
+            write_cache(args.cache, cache)
@@ -2,15 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import os, sys, shutil, glob
+import concurrent.futures
 import docopt, yaml
 from apefind.util import script
+from apefind.util.path import read_cache, write_cache
 
 
 log = script.get_logger()
 
 
 USAGE = """usage:
-    sync_app_locations.py [--appdir=<appdir>] [--configuration=<yaml>]
+    sync_app_locations.py [--appdir=<appdir>] [--configuration=<yaml>] [--state=<json>] [--jobs=<jobs>]
 """
 
 
@@ -37,7 +39,46 @@ APPLICATIONS = """
 """
 
 
-def sync_app_locations(appdir, applications):
+def get_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def replace_app(path, target):
+    """Rename path over target, an existing target is only deleted after the new one is in place"""
+    old = None
+    if os.path.abspath(path) == os.path.abspath(target):
+        return
+    if os.path.islink(target):
+        os.remove(target)
+    elif os.path.exists(target):
+        old = target + ".%d.old" % os.getpid()
+        os.rename(target, old)
+    os.rename(path, target)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def copy_app(path, target):
+    """Copy to a temporary name on the target volume, rename it into place and delete the original"""
+    tmp = target + ".%d.tmp" % os.getpid()
+    try:
+        shutil.copytree(path, tmp, symlinks=True)
+        replace_app(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(path)
+    return target
+
+
+def sync_app_locations(appdir, applications, state=None, jobs=4):
     def get_app_categories(applications):
         D = {}
         for category, apps in applications.items():
@@ -46,31 +87,93 @@ def sync_app_locations(appdir, applications):
         return D
 
     def get_app_and_category(filename):
-        app = os.path.basename(os.path.splitext(path)[0])
+        app = os.path.basename(os.path.splitext(filename)[0])
         return app, categories.get(app)
 
-    def move_app(app, category):
-        path = appdir + os.sep + category + os.sep + app + ".app"
-        if os.path.islink(path):
-            os.remove(path)
-        elif os.path.exists(path):
-            shutil.rmtree(path)
-        path, location = (
-            appdir + os.sep + app + ".app",
-            appdir + os.sep + categories[app],
-        )
+    def get_target(app, category):
+        return appdir + os.sep + category + os.sep + app + ".app"
+
+    def get_identity(path):
+        st = os.stat(path)
+        return [st.st_dev, st.st_ino]
+
+    def is_placed(app, category):
+        entry = state.get(app)
+        if entry is None or entry["category"] != category:
+            return False
+        try:
+            return get_identity(get_target(app, category)) == entry["identity"]
+        except OSError:
+            return False
+
+    def get_moves():
+        moves, installed, placed = [], set(), 0
+        for path in sorted(glob.glob(appdir + os.sep + "*.app")):
+            app, category = get_app_and_category(path)
+            if category is not None:
+                moves.append((app, path, category))
+                installed.add(app)
+            else:
+                log.info("        %s -> no category found" % (app,))
+        for app, entry in sorted(state.items()):
+            category = categories.get(app)
+            if app in installed or category is None:
+                continue
+            if is_placed(app, category):
+                placed += 1
+                continue
+            path = get_target(app, entry["category"])
+            if category == entry["category"] and os.path.exists(path):
+                state[app] = {"category": category, "identity": get_identity(path)}  # updated in place
+                placed += 1
+            elif os.path.exists(path):
+                moves.append((app, path, category))
+        return moves, placed
+
+    def move_app(app, path, category):
+        location, target = appdir + os.sep + category, get_target(app, category)
         os.makedirs(location, exist_ok=True)
-        shutil.move(path, appdir + os.sep + categories[app])
+        if os.stat(path).st_dev != os.stat(location).st_dev:
+            return False
+        replace_app(path, target)
+        state[app] = {"category": category, "identity": get_identity(target)}
+        return True
 
     log.info("    * syncing app locations")
     categories = get_app_categories(applications)
-    for path in glob.glob(appdir + os.sep + "*.app"):
-        app, category = get_app_and_category(path)
-        if category is not None:
-            log.info("        %s -> %s" % (app, category))
-            move_app(app, category)
-        else:
-            log.info("        %s -> no category found" % (app,))
+    state = {} if state is None else state
+    moves, placed = get_moves()
+    copies = []
+    for app, path, category in moves:
+        try:
+            if not move_app(app, path, category):
+                copies.append((app, path, category))
+                continue
+        except OSError as err:
+            log.warning("        %s -> %s failed: %s" % (app, category, err))
+            continue
+        log.info("        %s -> %s" % (app, category))
+    if placed > 0:
+        log.info("        %d apps already in place" % placed)
+    if copies:
+        sizes = {app: get_size(path) for app, path, _ in copies}
+        total, done = sum(sizes.values()), 0
+        log.info("    * copying %d apps across volumes (%d MB)" % (len(copies), total >> 20))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(copy_app, path, get_target(app, category)): (app, category)
+                for app, path, category in copies
+            }
+            for future in concurrent.futures.as_completed(futures):
+                app, category = futures[future]
+                try:
+                    state[app] = {"category": category, "identity": get_identity(future.result())}
+                except Exception as err:
+                    log.warning("        %s -> %s failed: %s" % (app, category, err))
+                    continue
+                done += sizes[app]
+                log.info("        %s -> %s (%d/%d MB)" % (app, category, done >> 20, total >> 20))
+    return state
 
 
 @script.run()
@@ -83,7 +186,10 @@ def run_script(args):
             applications = yaml.load(f, Loader=yaml.FullLoader)
     else:
         applications = yaml.load(APPLICATIONS, Loader=yaml.FullLoader)
-    sync_app_locations(appdir, applications)
+    statefile = args.get("--state") or appdir + os.sep + ".sync_app_locations.json"
+    jobs = int(args.get("--jobs") or 4)
+    state = sync_app_locations(appdir, applications, read_cache(statefile), jobs)
+    write_cache(statefile, state, indent=4)
 
 
 if __name__ == "__main__":
@@ -12,7 +12,13 @@
             ...
 """
 
+import concurrent.futures
+import json
 import os
+import stat
+import sys
+import threading
+import time
 
 import yaml
 
@@ -20,6 +26,12 @@ from apefind.util import script
 from apefind.util.path import expand_path
 from apefind.util.script import _ok, _nok
 
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler, Observer = object, None
+
 log = script.get_logger()
 
 
@@ -27,9 +39,14 @@ def parse_args(args=None, namespace=None):
     parser = script.ArgumentParser()
     parser.add_argument("-config")
     parser.add_commands(required=True)
-    for command in "install", "uninstall", "check":
+    for command in "install", "uninstall", "check", "watch":
         cmd = parser.add_command(command)
         cmd.add_argument("-site", nargs="*")
+        if command == "watch":
+            cmd.add_argument("-interval", type=float, default=2.0, help="seconds between polls or event batches")
+        if command == "check":
+            cmd.add_argument("-jobs", type=int, default=8, help="number of sites checked at the same time")
+            cmd.add_argument("-json", help="write a json report to this file")
     return parser.parse_args(
         args=args,
         namespace=namespace,
@@ -52,12 +69,26 @@ def get_symlink_paths(basedir, target, source):
     )
 
 
+def is_symlink_installed(target, source):
+    try:
+        return os.readlink(target) == source
+    except OSError:
+        return False
+
+
 def create_symlink(target, source):
+    """Create or atomically replace target, the new link is created under a temporary name first"""
     if not os.path.exists(source):
         raise OSError(f"{source} does not exist")
-    if os.path.islink(target):
-        os.remove(target)
-    os.symlink(source, target)
+    if os.path.lexists(target) and not os.path.islink(target):
+        raise OSError(f"{target} is not a symlink")
+    tmp = f"{target}.{os.getpid()}.tmp"
+    os.symlink(source, tmp)
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        os.remove(tmp)
+        raise
 
 
 def remove_symlink(target):
@@ -65,25 +96,52 @@ def remove_symlink(target):
         os.remove(target)
 
 
-def check_symlink(target, source):
-    if not os.path.exists(source):
+class RealpathCache:
+    """Resolve every path only once, shared by all sites and threads of a check"""
+
+    def __init__(self):
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        try:
+            return self._paths[path]
+        except KeyError:
+            pass
+        resolved = os.path.realpath(path)
+        with self._lock:
+            self._paths[path] = resolved
+        return resolved
+
+
+def check_symlink(target, source, realpath=os.path.realpath):
+    resolved = realpath(source)
+    if not os.path.exists(resolved):
         raise OSError(f"{source} does not exist")
-    if not os.path.exists(target):
+    try:
+        st = os.lstat(target)
+    except FileNotFoundError:
         raise OSError(f"{target} does not exist")
-    if not os.path.islink(target):
+    if not stat.S_ISLNK(st.st_mode):
         raise OSError(f"{target} is not a symlink")
-    if not os.path.realpath(target) == os.path.realpath(source):
+    if not realpath(target) == resolved:
         raise OSError(f"linked to {os.readlink(target)}")
 
 
 def install_symlinks(basedir, symlinks):
     log.info(f"    * creating symbolic links in {basedir}")
+    unchanged = 0
     for target, source in sorted(symlinks.items()):
         try:
-            create_symlink(*get_symlink_paths(basedir, target, source))
+            target_path, source_path = get_symlink_paths(basedir, target, source)
+            if is_symlink_installed(target_path, source_path) and os.path.exists(source_path):
+                unchanged += 1
+                continue
+            create_symlink(target_path, source_path)
             log.info(f"        {target} -> {source} {_ok}")
         except Exception as err:
             log.warning(f"        {target} -> {source}: {err} {_nok}")
+    log.info(f"        {unchanged} links already installed {_ok}")
 
 
 def uninstall_symlinks(basedir, symlinks):
@@ -96,18 +154,193 @@ def uninstall_symlinks(basedir, symlinks):
             log.warning(f"        {target} -> {source}: {err} {_nok}")
 
 
-def check_symlinks(basedir, symlinks):
-    log.info(f"    * checking symbolic links in {basedir}")
+def check_symlinks(basedir, symlinks, realpath=os.path.realpath):
+    results = []
     for target, source in sorted(symlinks.items()):
+        t0 = time.perf_counter()
         try:
-            check_symlink(*get_symlink_paths(basedir, target, source))
-            log.info(f"        {target} -> {source} {_ok}")
+            check_symlink(*get_symlink_paths(basedir, target, source), realpath)
+            error = None
         except Exception as err:
-            log.warning(f"        {target} -> {source}: {err} {_nok}")
+            error = str(err)
+        results.append({
+            "target": target,
+            "source": source,
+            "ok": error is None,
+            "error": error,
+            "seconds": time.perf_counter() - t0,
+        })
+    return results
+
+
+def log_check_results(basedir, results):
+    log.info(f"    * checking symbolic links in {basedir}")
+    for r in results:
+        if r["ok"]:
+            log.info(f"        {r['target']} -> {r['source']} {_ok}")
+        else:
+            log.warning(f"        {r['target']} -> {r['source']}: {r['error']} {_nok}")
+
+
+def check_sites(conf, sites, jobs=8):
+    """Check all sites at the same time, return the report with per link status and timing"""
+    t0, realpath = time.perf_counter(), RealpathCache()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {site: pool.submit(check_symlinks, *get_symlinks(conf, site), realpath) for site in sites}
+        report = {
+            site: {"basedir": get_symlinks(conf, site)[0], "links": future.result()}
+            for site, future in futures.items()
+        }
+    return {
+        "ok": all(r["ok"] for site in report.values() for r in site["links"]),
+        "seconds": time.perf_counter() - t0,
+        "sites": report,
+    }
+
+
+def write_check_report(report, filepath):
+    with open(expand_path(filepath), "w") as f:
+        json.dump(report, f, indent=4)
+
+
+class ChangeCollector(FileSystemEventHandler):
+    """Collect the paths of file system events between two sync passes"""
+
+    def __init__(self):
+        super().__init__()
+        self._paths = set()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return  # reading the config must not wake up the loop
+        with self._lock:
+            self._paths.add(os.fsdecode(event.src_path))
+            if getattr(event, "dest_path", None):
+                self._paths.add(os.fsdecode(event.dest_path))
+        self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        with self._lock:
+            paths, self._paths = self._paths, set()
+            self._event.clear()
+        return paths
+
+
+def read_config(config):
+    with open(config, "r") as f:
+        conf = yaml.load(f, Loader=yaml.FullLoader)
+    if not isinstance(conf, dict):
+        raise yaml.YAMLError("not a mapping of sites")  # also an empty, half written file
+    return conf
+
+
+def get_site_entries(conf, sites=None):
+    """Return (site, target) -> (target path, source path) of all links"""
+    entries = {}
+    for site in conf.keys() if sites is None else sites:
+        basedir, symlinks = get_symlinks(conf, site)
+        for target, source in symlinks.items():
+            entries[site, target] = get_symlink_paths(basedir, target, source)
+    return entries
+
+
+def get_affected_entries(entries, paths):
+    """Return the entries whose target or source is one of the paths or lies below one of them"""
+    affected = set()
+    for path in paths:
+        prefix = path + os.sep
+        for key, (target, source) in entries.items():
+            if target == path or source == path or target.startswith(prefix) or source.startswith(prefix):
+                affected.add(key)
+    return affected
+
+
+def schedule_watches(observer, collector, config, entries):
+    """Watch the config and the parent directories of all links, return the entries that must be polled"""
+    observer.unschedule_all()
+    dirs, polled = {os.path.dirname(config)}, set()
+    for key, paths in entries.items():
+        parents = {os.path.dirname(p) for p in paths}
+        if all(os.path.isdir(d) for d in parents):
+            dirs |= parents
+        else:
+            polled.add(key)
+    for d in sorted(dirs):
+        observer.schedule(collector, d, recursive=False)
+    return polled
+
+
+def sync_entry(target, source):
+    if is_symlink_installed(target, source) and os.path.exists(source):
+        return False
+    create_symlink(target, source)
+    return True
+
+
+def watch_symlinks(config, sites=None, interval=2.0):
+    """Re-sync only links whose config entry, source or target changed"""
+    config = os.path.abspath(expand_path(config))
+    log.info(f"    * watching {config} ({'events' if Observer is not None else 'polling'})")
+    entries, errors, mtime, polled, paths = {}, {}, None, set(), set()
+    collector = ChangeCollector() if Observer is not None else None
+    observer = Observer() if Observer is not None else None
+    if observer is not None:
+        observer.start()
+    try:
+        while True:
+            try:
+                st = os.stat(config).st_mtime_ns
+                current = get_site_entries(read_config(config), sites) if st != mtime else None
+            except (OSError, yaml.YAMLError, KeyError, TypeError, AttributeError) as err:
+                if errors.get(config) != str(err):
+                    log.warning(f"        {config}: {err} {_nok}")
+                errors[config] = str(err)
+                st, current = mtime, None
+            else:
+                errors.pop(config, None)
+            mtime = st
+            if current is not None:
+                for key in entries.keys() - current.keys():
+                    target, source = entries[key]
+                    if is_symlink_installed(target, source):
+                        remove_symlink(target)
+                        log.info(f"        {key[0]}: {key[1]} removed {_ok}")
+                    errors.pop(key, None)
+                affected = {key for key, paths_ in current.items() if entries.get(key) != paths_}
+                entries = current
+                if observer is not None:
+                    polled = schedule_watches(observer, collector, config, entries)
+                    affected |= get_affected_entries(entries, paths) | polled
+                else:
+                    affected = set(entries)
+            elif collector is None:
+                affected = set(entries)
+            else:
+                affected = get_affected_entries(entries, paths) | polled
+            for key in sorted(affected):
+                try:
+                    if sync_entry(*entries[key]):
+                        log.info(f"        {key[0]}: {key[1]} -> {entries[key][1]} {_ok}")
+                    errors.pop(key, None)
+                except Exception as err:
+                    if errors.get(key) != str(err):
+                        log.warning(f"        {key[0]}: {key[1]}: {err} {_nok}")
+                    errors[key] = str(err)
+            paths = collector.wait(interval) if collector is not None else time.sleep(interval)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
 
 
 @script.run()
 def run_script(args):
+    if args.cmd == "watch":
+        watch_symlinks(args.config, args.site, args.interval)
+        return
     with open(expand_path(args.config), "r") as f:
         conf = yaml.load(f, Loader=yaml.FullLoader)
     if args.site is None:
@@ -119,8 +352,13 @@ def run_script(args):
         for site in args.site:
             uninstall_symlinks(*get_symlinks(conf, site))
     elif args.cmd == "check":
-        for site in args.site:
-            check_symlinks(*get_symlinks(conf, site))
+        report = check_sites(conf, args.site, args.jobs)
+        for site in report["sites"].values():
+            log_check_results(site["basedir"], site["links"])
+        if args.json is not None:
+            write_check_report(report, args.json)
+        if not report["ok"]:
+            sys.exit(1)  # broken links fail monitoring jobs
 
 
 if __name__ == "__main__":
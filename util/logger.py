@@ -1,6 +1,9 @@
+import atexit
 import os
+import queue
 import sys
 from logging import *
+from logging.handlers import QueueHandler, QueueListener
 
 try:
     from colorlog import ColoredFormatter
@@ -24,7 +27,15 @@ def expand_logfile_path(logfile):
     return filepath
 
 
-def get_logger(name, logfile=None, mode="w", color_formatter=None):
+def add_handler(logger, handler):
+    if hasattr(logger, "listener"):
+        logger.listener.handlers += (handler,)
+    else:
+        logger.addHandler(handler)
+
+
+def get_logger(name, logfile=None, mode="w", color_formatter=None, queued=False):
+    """With queued, records are written by a background thread instead of the logging one"""
     logger = getLogger(name)
     if not hasattr(logger, "console"):
         logger.console = StreamHandler(sys.stdout)
@@ -34,17 +45,31 @@ def get_logger(name, logfile=None, mode="w", color_formatter=None):
                     logger.console.setFormatter(color_formatter)
             except:
                 pass
-        logger.addHandler(logger.console)
+        if queued:
+            logger.listener = QueueListener(queue.SimpleQueue(), respect_handler_level=True)
+            logger.addHandler(QueueHandler(logger.listener.queue))
+            logger.listener.start()
+            atexit.register(logger.listener.stop)
+        add_handler(logger, logger.console)
         logger.setLevel(DEBUG)
         logger.console.setLevel(INFO)
     if not hasattr(logger, "logfile"):
         if logfile is not None:
             logger.file = FileHandler(logfile, mode)
             logger.file.filepath = logfile
-            logger.addHandler(logger.file)
+            add_handler(logger, logger.file)
             logger.file.setLevel(DEBUG)
     return logger
 
 
+def flush_logger(logger):
+    """Wait until a queued logger has written all pending records"""
+    if hasattr(logger, "listener"):
+        logger.listener.stop()
+        logger.listener.start()
+    for handler in logger.handlers:
+        handler.flush()
+
+
 def get_console_logger(name, color_formatter=COLOR_FORMATTER):
     return get_logger(name, color_formatter=color_formatter)
@@ -1,6 +1,17 @@
+import collections
+import concurrent.futures
+import fnmatch
+import json
 import os
 
-from typing import Tuple
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class FileEntry(NamedTuple):
+    path: str
+    name: str
+    size: Optional[int] = None
+    mtime: Optional[float] = None
 
 
 def get_filepath_name(filepath: str) -> str:
@@ -23,3 +34,87 @@ def split_filepath(filepath: str) -> Tuple[str, str, str]:
 def expand_path(path: str) -> str:
     """Expand variables and ~"""
     return os.path.expanduser(os.path.expandvars(path))
+
+
+def read_cache(filepath: Optional[str]) -> dict:
+    """Return the JSON cache, empty if filepath is empty, missing or broken"""
+    if not filepath:
+        return {}
+    try:
+        with open(expand_path(filepath), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_cache(filepath: Optional[str], cache: dict, indent: Optional[int] = None) -> None:
+    """Write the JSON cache atomically, nothing if filepath is empty"""
+    if not filepath:
+        return
+    filepath = expand_path(filepath)
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    with open(filepath + ".tmp", "w") as f:
+        json.dump(cache, f, indent=indent)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def walk_files(
+    top: str,
+    exts: Optional[Iterable[str]] = None,
+    names: Optional[Iterable[str]] = None,
+    prune: Optional[Callable[[os.DirEntry], bool]] = None,
+    stat: bool = False,
+    threads: int = 0,
+) -> Iterator[FileEntry]:
+    """Yield the files below top in no particular order
+
+    exts are case-insensitive extensions with leading ., names are fnmatch patterns,
+    directories for which prune returns True are not entered. With stat the size and
+    mtime come from the DirEntry, threads > 0 scans directories on a thread pool.
+    """
+    exts = None if exts is None else {ext.lower() for ext in exts}
+    names = None if names is None else list(names)
+
+    def is_selected(name):
+        if exts is not None and os.path.splitext(name)[1].lower() not in exts:
+            return False
+        return names is None or any(fnmatch.fnmatch(name, pattern) for pattern in names)
+
+    def scan(directory) -> Tuple[List[FileEntry], List[str]]:
+        files, dirs = [], []
+        try:
+            with os.scandir(directory) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if prune is None or not prune(e):
+                                dirs.append(e.path)
+                        elif is_selected(e.name):
+                            if stat:
+                                st = e.stat(follow_symlinks=False)
+                                files.append(FileEntry(e.path, e.name, st.st_size, st.st_mtime))
+                            else:
+                                files.append(FileEntry(e.path, e.name))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return files, dirs
+
+    if threads <= 0:
+        stack = [os.fspath(top)]
+        while stack:
+            files, dirs = scan(stack.pop())
+            yield from files
+            stack += reversed(dirs)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        waiting, running = collections.deque([os.fspath(top)]), set()
+        while waiting or running:
+            while waiting and len(running) < 2 * threads:
+                running.add(pool.submit(scan, waiting.pop()))
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                waiting.extend(dirs)
+                yield from files
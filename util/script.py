@@ -36,10 +36,10 @@ def get_script_name():
     return os.path.splitext(os.path.basename(sys.modules["__main__"].__file__))[0]
 
 
-def get_logger(name=None, logfile=None, mode="w", color_formatter=logger.COLOR_FORMATTER):
+def get_logger(name=None, logfile=None, mode="w", color_formatter=logger.COLOR_FORMATTER, queued=False):
     if name is None:
         name = get_script_name()
-    return logger.get_logger(name, logfile, mode, color_formatter)
+    return logger.get_logger(name, logfile, mode, color_formatter, queued)
 
 
 def run(name=None, log=None):
@@ -59,6 +59,7 @@ def run(name=None, log=None):
                 duration = str(t1 - t0).split(".")[0]
                 log.info(f"    * terminated at {t1.strftime('%c')}, total duration {duration}")
                 log.info("done")
+                logger.flush_logger(log)
 
         return wrapper
 